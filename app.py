@@ -1,29 +1,221 @@
 import streamlit as st
 import PyPDF2
 import json
+import io
 import os
+import time
 import tempfile
+import hashlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import google.generativeai as genai
+from google.api_core.exceptions import DeadlineExceeded, InternalServerError, ResourceExhausted, ServiceUnavailable
 import re
 from datetime import datetime
 
+# orjson parses and serializes several times faster; fall back to the stdlib when it is not installed
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
+GEMINI_MODEL = 'gemini-pro'
+# Output token limit of GEMINI_MODEL; update alongside the model name
+GEMINI_OUTPUT_TOKEN_LIMIT = 2048
+
+# Bump PROMPT_VERSION whenever a prompt changes so cached responses are not reused
+PROMPT_VERSION = 'v2'
+LLM_CACHE_DIR = '.llm_cache'
+
+PAGES_PER_CHUNK = 5
+
+# Upper bound on concurrent Gemini requests, to stay under the RPM limit
+MAX_CONCURRENT_REQUESTS = 8
+
+# Per-request Gemini timeout in seconds (overridable via LLM_REQUEST_TIMEOUT) and retries after a timeout
+# or transient server error; auth and invalid-request errors are never retried
+DEFAULT_REQUEST_TIMEOUT = 60.0
+# A streamed answer shares one deadline for the whole stream (overridable via LLM_STREAM_TIMEOUT),
+# and only the call that opens the stream is retried
+DEFAULT_STREAM_TIMEOUT = 300.0
+MAX_RETRIES = 2
+RETRYABLE_ERRORS = (DeadlineExceeded, TimeoutError, ResourceExhausted, ServiceUnavailable, InternalServerError)
+
+# Chunks packed into a single extraction prompt are bounded by total prompt size and by the
+# model's output token limit, budgeting EXTRACTION_OUTPUT_TOKENS per chunk so every extraction fits
+MAX_PROMPT_CHARS = 100000
+EXTRACTION_OUTPUT_TOKENS = 1024
+CHUNKS_PER_PROMPT = max(1, GEMINI_OUTPUT_TOKEN_LIMIT // EXTRACTION_OUTPUT_TOKENS)
+
+# Outermost JSON array in a batched extraction response, ignoring any surrounding code fence
+JSON_ARRAY_PATTERN = re.compile(r'\[.*\]', re.DOTALL)
+
+# Prompt templates, filled in per call with str.format
+QUERY_PROMPT = """
+Given the following financial data and user query, please provide a specific and concise answer.
+Only return information that is directly relevant to the query.
+
+Financial Data:
+{data}
+
+User Query: {query}
+"""
+
+EXTRACTION_PROMPT = """
+You are a financial data extraction expert. Please analyze the following text and extract all financial information.
+
+Focus on extracting:
+1. All numerical figures with their context
+2. Financial metrics and KPIs
+3. Revenue, profit, and loss figures
+4. Growth percentages and trends
+5. Market-related figures
+6. Any other relevant financial data
+
+Format your response as a clear tabular list, grouping similar items together.
+Each data point should include its full context and any relevant time period or date.
+
+Text to analyze:
+{text}
+"""
+
+BATCH_EXTRACTION_PROMPT = """
+You are a financial data extraction expert. Below are {count} numbered chunks of text from the same document.
+Analyze each chunk independently and extract all financial information.
+
+Focus on extracting:
+1. All numerical figures with their context
+2. Financial metrics and KPIs
+3. Revenue, profit, and loss figures
+4. Growth percentages and trends
+5. Market-related figures
+6. Any other relevant financial data
+
+Format each extraction as a clear tabular list, grouping similar items together.
+Each data point should include its full context and any relevant time period or date.
+
+Return ONLY a JSON array of {count} strings, where element N is the extraction for CHUNK N+1.
+
+{chunks}
+"""
+
+MERGE_PROMPT = """
+You are a financial data consolidation expert. Below are multiple extractions from different parts of a document.
+Please merge this information into a single, coherent summary. Remove any duplicates and organize related information together.
+
+Previous extractions:
+{extractions}
+"""
+
+@st.cache_data(show_spinner=False)
+def load_config(config_path):
+    """Read and parse the JSON config file once per process."""
+    with open(config_path, 'rb') as config_file:
+        return json_loads(config_file.read())
+
+@st.cache_resource(show_spinner=False)
+def get_gemini_model(api_key):
+    """Configure Gemini once and share the model client across reruns and sessions."""
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(GEMINI_MODEL)
+
+def iter_page_texts(pdf_reader):
+    """Yield the extracted text of each page that has any."""
+    for page in pdf_reader.pages:
+        text = page.extract_text()
+        if text:
+            yield text
+
 class FinancialDataExtractor:
     def __init__(self, config_path='config.json'):
-        with open(config_path, 'r') as config_file:
-            config_data = json.load(config_file)
+        config_data = load_config(config_path)
         
         gemini_api_key = config_data.get('GEMINI_API_KEY')
         if not gemini_api_key:
             raise ValueError("Gemini API key not found in config file")
         
-        genai.configure(api_key=gemini_api_key)
-        self.model = genai.GenerativeModel('gemini-pro')
+        self.request_timeout = float(config_data.get('LLM_REQUEST_TIMEOUT', DEFAULT_REQUEST_TIMEOUT))
+        self.stream_timeout = float(config_data.get('LLM_STREAM_TIMEOUT', DEFAULT_STREAM_TIMEOUT))
+        
+        self.model = get_gemini_model(gemini_api_key)
         
         # Initialize cache in session state
         st.session_state.setdefault("pdf_chunks", {})
         st.session_state.setdefault("chunk_extractions", {})
         st.session_state.setdefault("raw_extractions", [])
         st.session_state.setdefault("consolidated_data", None)
+        st.session_state.setdefault("merged_extractions", {})
+        st.session_state.setdefault("query_responses", {})
+
+    def cache_key(self, *parts):
+        """Hash the model name, prompt version and prompt inputs into an LLM response cache key."""
+        digest = hashlib.sha256()
+        for part in (GEMINI_MODEL, PROMPT_VERSION, *parts):
+            data = part.encode()
+            # Length-prefix each part so different splits of the same bytes cannot collide
+            digest.update(len(data).to_bytes(8, 'little'))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def read_cached_response(self, cache_key):
+        """Return an LLM response persisted on disk, or None on a miss."""
+        cache_path = os.path.join(LLM_CACHE_DIR, f"{cache_key}.json")
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                entry = json_loads(cache_file.read())
+        except OSError:
+            # Missing files are plain misses; other I/O errors may be transient, so keep the entry
+            return None
+        except ValueError:
+            entry = None
+        
+        if not isinstance(entry, dict) or entry.get('model') != GEMINI_MODEL or not isinstance(entry.get('response'), str):
+            # Evict entries that are corrupt or were written in a different shape
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+            return None
+        
+        return entry['response']
+
+    def write_cached_response(self, cache_key, response_text):
+        """Persist an LLM response on disk so later sessions can reuse it."""
+        temp_path = None
+        try:
+            os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+            # Sessions are threads of one process, so the temp name must be unique per write
+            with tempfile.NamedTemporaryFile(dir=LLM_CACHE_DIR, suffix='.tmp', delete=False) as cache_file:
+                temp_path = cache_file.name
+                cache_file.write(json_dumps({"response": response_text, "ts": time.time(), "model": GEMINI_MODEL}))
+            os.replace(temp_path, os.path.join(LLM_CACHE_DIR, f"{cache_key}.json"))
+        except OSError:
+            # The disk cache is an optimization only; just don't leave a partial temp file behind
+            if temp_path:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    def generate(self, prompt, **kwargs):
+        """Call Gemini with a request timeout, retrying timeouts and transient errors with backoff."""
+        timeout = self.stream_timeout if kwargs.get('stream') else self.request_timeout
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                return self.model.generate_content(
+                    prompt, request_options={'timeout': timeout}, **kwargs
+                )
+            except RETRYABLE_ERRORS as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                st.toast(f"Gemini request failed ({type(e).__name__}), retrying (attempt {attempt + 2} of {MAX_RETRIES + 1})")
+                time.sleep(1.0 * (attempt + 1))
 
     def convert_date_to_fiscal_quarter(self, date_str):
         try:
@@ -48,24 +240,21 @@ class FinancialDataExtractor:
         except:
             return "Unknown"
 
-    def extract_text_from_pdf(self, pdf_path):
-        """Extract text from PDF and divide into chunks of 5 pages."""
+    @staticmethod
+    @st.cache_data(show_spinner=False, max_entries=8)
+    def extract_text_from_pdf(pdf_bytes):
+        """Extract text from PDF bytes and divide into chunks of 5 pages."""
         try:
             chunks = {}
-            with open(pdf_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                total_pages = len(pdf_reader.pages)
-                
-                # Create chunks of 5 pages
-                for i in range(0, total_pages, 5):
-                    chunk_text = []
-                    for j in range(i, min(i + 5, total_pages)):
-                        text = pdf_reader.pages[j].extract_text()
-                        if text:
-                            chunk_text.append(text)
-                    
-                    if chunk_text:
-                        chunks[f"chunk_{i//5}"] = '\n\n'.join(chunk_text)
+            pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+            pages = iter_page_texts(pdf_reader)
+            
+            # Create chunks of PAGES_PER_CHUNK pages, pulling page text lazily one chunk at a time
+            for index in itertools.count():
+                chunk_text = '\n\n'.join(itertools.islice(pages, PAGES_PER_CHUNK))
+                if not chunk_text:
+                    break
+                chunks[f"chunk_{index}"] = chunk_text
             
             return chunks
         except Exception as e:
@@ -73,93 +262,196 @@ class FinancialDataExtractor:
             return {}
 
     def query_financial_data(self, user_query):
-        """Search for financial details in the cached consolidated data."""
+        """Search for financial details in the cached consolidated data, yielding the answer as it streams in."""
         if not st.session_state.consolidated_data:
-            return "No financial data available. Please extract data first."
+            yield "No financial data available. Please extract data first."
+            return
+
+        cache_key = self.cache_key(st.session_state.consolidated_data, user_query.strip())
+        if cache_key in st.session_state.query_responses:
+            yield st.session_state.query_responses[cache_key]
+            return
 
         try:
-            search_prompt = """
-            Given the following financial data and user query, please provide a specific and concise answer.
-            Only return information that is directly relevant to the query.
-            
-            Financial Data:
-            {data}
-            
-            User Query: {query}
-            """
-            
-            response = self.model.generate_content(
-                search_prompt.format(
+            response = self.generate(
+                QUERY_PROMPT.format(
                     data=st.session_state.consolidated_data,
                     query=user_query
-                )
+                ),
+                stream=True
             )
             
-            if not response or not response.text:
-                return "No relevant information found"
-                
-            return response.text
+            parts = []
+            for chunk in response:
+                # Finish-reason-only and safety-stopped chunks carry no parts, and .text raises on them
+                if chunk.parts and chunk.text:
+                    parts.append(chunk.text)
+                    yield chunk.text
+            
+            if not parts:
+                yield "No relevant information found"
+                return
+            
+            st.session_state.query_responses[cache_key] = "".join(parts)
             
         except Exception as e:
             st.error(f"Error searching data: {str(e)}")
-            return "Error processing query"
+            yield "Error processing query"
 
     def extract_financial_data(self, text):
-        """Extract financial data from text using Gemini AI."""
+        """Extract financial data from text using Gemini AI, returning None if the extraction failed."""
         try:
-            prompt = """
-            You are a financial data extraction expert. Please analyze the following text and extract all financial information.
-            
-            Focus on extracting:
-            1. All numerical figures with their context
-            2. Financial metrics and KPIs
-            3. Revenue, profit, and loss figures
-            4. Growth percentages and trends
-            5. Market-related figures
-            6. Any other relevant financial data
-            
-            Format your response as a clear tabular list, grouping similar items together.
-            Each data point should include its full context and any relevant time period or date.
-            
-            Text to analyze:
-            {text}
-            """
-            
-            response = self.model.generate_content(prompt.format(text=text))
+            response = self.generate(EXTRACTION_PROMPT.format(text=text))
             
             # Check if response is empty or error occurred
             if not response or not response.text:
-                return "No financial data could be extracted"
-                
+                return None
+            
+            self.write_cached_response(self.cache_key(text), response.text)
             return response.text
             
         except Exception as e:
             st.error(f"Error extracting financial data: {str(e)}")
-            return "Error processing financial data"
+            return None
+
+    def extract_financial_data_batch(self, texts):
+        """Extract financial data from several chunks in a single Gemini request.
 
-    def process_pdf(self, pdf_path):
+        Returns one extraction per chunk, None for every chunk if the request itself failed,
+        or None instead of a list if the response was truncated or could not be parsed.
+        """
+        numbered_chunks = "\n\n".join(f"CHUNK {i}:\n{text}" for i, text in enumerate(texts, start=1))
+        try:
+            response = self.generate(
+                BATCH_EXTRACTION_PROMPT.format(count=len(texts), chunks=numbered_chunks),
+                generation_config={'max_output_tokens': GEMINI_OUTPUT_TOKEN_LIMIT}
+            )
+        except Exception as e:
+            # generate() has already retried transient errors, so resending per chunk would only multiply requests
+            st.error(f"Error extracting financial data: {str(e)}")
+            return [None] * len(texts)
+
+        try:
+            # A response cut off at the output limit cannot hold the full array
+            if not response or not response.candidates:
+                return None
+            if response.candidates[0].finish_reason == genai.protos.Candidate.FinishReason.MAX_TOKENS:
+                return None
+            if not response.text:
+                return None
+            
+            match = JSON_ARRAY_PATTERN.search(response.text)
+            extractions = json_loads(match.group()) if match else None
+            if (
+                not isinstance(extractions, list)
+                or len(extractions) != len(texts)
+                or not all(isinstance(extraction, str) for extraction in extractions)
+            ):
+                return None
+            
+            # Batched results come from a different prompt, so they get their own disk cache key
+            for text, extraction in zip(texts, extractions):
+                self.write_cached_response(self.cache_key('batch', text), extraction)
+            return extractions
+            
+        except ValueError:
+            # Raised by response.text for a blocked reply and by json_loads for malformed JSON
+            return None
+
+    def group_chunks(self, chunks):
+        """Group chunks into batches whose input and expected output fit in a single extraction request."""
+        batches, batch, batch_chars = [], {}, 0
+        for chunk_id, chunk_text in chunks.items():
+            if batch and (len(batch) == CHUNKS_PER_PROMPT or batch_chars + len(chunk_text) > MAX_PROMPT_CHARS):
+                batches.append(batch)
+                batch, batch_chars = {}, 0
+            batch[chunk_id] = chunk_text
+            batch_chars += len(chunk_text)
+        
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def extract_chunks(self, chunks):
+        """Extract financial data from several chunks concurrently."""
+        batches = [list(batch.values()) for batch in self.group_chunks(chunks)]
+
+        def extract_batch(texts):
+            return self.extract_financial_data_batch(texts) if len(texts) > 1 else None
+        
+        # Worker threads need the script run context for st.error to reach the page
+        with ThreadPoolExecutor(
+            max_workers=MAX_CONCURRENT_REQUESTS,
+            initializer=add_script_run_ctx,
+            initargs=(None, get_script_run_ctx()),
+        ) as executor:
+            results = list(executor.map(extract_batch, batches))
+            
+            # Fall back to one request per chunk for single-chunk batches and truncated or unparseable
+            # batch responses; chunks whose batch request failed outright stay failed
+            fallback_texts = [
+                text for texts, extractions in zip(batches, results) if extractions is None for text in texts
+            ]
+            fallback = iter(executor.map(self.extract_financial_data, fallback_texts))
+        
+        extractions = []
+        for texts, batch_extractions in zip(batches, results):
+            extractions.extend([next(fallback) for _ in texts] if batch_extractions is None else batch_extractions)
+        return dict(zip(chunks, extractions))
+
+    def process_pdf(self, pdf_bytes):
         """Process PDF in chunks and cache the results."""
         try:
             # Extract text in chunks
-            chunks = self.extract_text_from_pdf(pdf_path)
+            chunks = self.extract_text_from_pdf(pdf_bytes)
             if not chunks:
                 return "No text could be extracted from the PDF"
             
             # Store chunks in session state
             st.session_state.pdf_chunks = chunks
             
-            # Process each chunk and store results
-            all_extractions = []
+            # Process chunks not seen before concurrently and cache results by content.
+            # Keying pending work on the content hash sends repeated chunks only once.
+            chunk_keys = {chunk_id: self.cache_key(chunk_text) for chunk_id, chunk_text in chunks.items()}
+            pending = {}
             for chunk_id, chunk_text in chunks.items():
-                # Check if chunk has been processed before
-                if chunk_id not in st.session_state.chunk_extractions:
-                    extracted_data = self.extract_financial_data(chunk_text)
-                    st.session_state.chunk_extractions[chunk_id] = extracted_data
+                cache_key = chunk_keys[chunk_id]
+                if cache_key in st.session_state.chunk_extractions or cache_key in pending:
+                    continue
                 
-                all_extractions.append(st.session_state.chunk_extractions[chunk_id])
+                # Reuse extractions persisted by earlier sessions, from either extraction prompt
+                cached_extraction = self.read_cached_response(cache_key)
+                if cached_extraction is None:
+                    cached_extraction = self.read_cached_response(self.cache_key('batch', chunk_text))
+                if cached_extraction is not None:
+                    st.session_state.chunk_extractions[cache_key] = cached_extraction
+                else:
+                    pending[cache_key] = chunk_text
             
-            # Merge all extractions
-            consolidated_data = self.merge_extractions(all_extractions)
+            # Only successful extractions are cached, so failed chunks are retried on the next run
+            if pending:
+                st.session_state.chunk_extractions.update(
+                    (cache_key, extraction)
+                    for cache_key, extraction in self.extract_chunks(pending).items()
+                    if extraction is not None
+                )
+            
+            all_extractions = [
+                st.session_state.chunk_extractions[chunk_keys[chunk_id]] for chunk_id in chunks
+                if chunk_keys[chunk_id] in st.session_state.chunk_extractions
+            ]
+            if not all_extractions:
+                return "No financial data could be extracted"
+            
+            failed_count = len(chunks) - len(all_extractions)
+            if failed_count:
+                st.warning(f"{failed_count} of {len(chunks)} sections could not be extracted; rerun to retry them.")
+            
+            # Merge all extractions, unless a single one already covers the document
+            if len(all_extractions) == 1:
+                consolidated_data = all_extractions[0]
+            else:
+                consolidated_data = self.merge_extractions(all_extractions)
             st.session_state.consolidated_data = consolidated_data
             
             return consolidated_data
@@ -170,23 +462,20 @@ class FinancialDataExtractor:
 
     def merge_extractions(self, extractions):
         """Merge multiple extraction results into a single consolidated view."""
+        cache_key = self.cache_key(*extractions)
+        if cache_key in st.session_state.merged_extractions:
+            return st.session_state.merged_extractions[cache_key]
+
         try:
-            merged_prompt = """
-            You are a financial data consolidation expert. Below are multiple extractions from different parts of a document.
-            Please merge this information into a single, coherent summary. Remove any duplicates and organize related information together.
-            
-            Previous extractions:
-            {extractions}
-            """
-            
             # Join all extractions with clear separation
             all_extractions = "\n\n--- Next Section ---\n\n".join(extractions)
             
-            response = self.model.generate_content(merged_prompt.format(extractions=all_extractions))
+            response = self.generate(MERGE_PROMPT.format(extractions=all_extractions))
             
             if not response or not response.text:
                 return "Could not consolidate the extracted data"
-                
+            
+            st.session_state.merged_extractions[cache_key] = response.text
             return response.text
             
         except Exception as e:
@@ -206,17 +495,11 @@ def main():
     uploaded_file = st.file_uploader("Upload Financial PDF", type=['pdf'])
 
     if uploaded_file:
-        temp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-        temp_pdf.write(uploaded_file.getvalue())
-        temp_pdf.close()
-
         with st.spinner("Processing PDF..."):
-            extracted_data = extractor.process_pdf(temp_pdf.name)
+            extracted_data = extractor.process_pdf(uploaded_file.getvalue())
             st.session_state.consolidated_data = extracted_data
             st.subheader("Extracted Financial Information")
             st.markdown(extracted_data)
-
-        os.unlink(temp_pdf.name)
     
     if st.session_state.consolidated_data:
         st.subheader("Financial Data Query")
@@ -224,9 +507,8 @@ def main():
 
         if st.button("Extract Specific Information"):
             if user_query:
-                with st.spinner("Searching locally..."):
-                    query_response = extractor.query_financial_data(user_query)
-                    st.text_area("Query Result", query_response, height=300)
+                st.subheader("Query Result")
+                st.write_stream(extractor.query_financial_data(user_query))
 
 
 if __name__ == "__main__":